@@ -1,8 +1,21 @@
 import os
+import sys
+import mmap
+import shutil
 import pandas as pd
 import numpy as np
+import matplotlib
+
+# Batch runs (input piped in, outside IPython/Spyder) skip the GUI backend entirely
+interactive = sys.stdin.isatty() or 'IPython' in sys.modules
+if not interactive:
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import requests
+from numba import njit
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
 from datetime import datetime, timedelta, date
 
 # USER INPUT 
@@ -36,77 +49,209 @@ for required_file in [station_file, inventory_file]:
         exit()
 
 #  LOAD & FILTER INVENTORY
-inventory = pd.read_csv(inventory_file, delim_whitespace=True, header=None,
-                        names=["ID", "LAT", "LON", "ELEMENT", "FIRSTYEAR", "LASTYEAR"])
-inventory['ID'] = inventory['ID'].astype(str).str.strip()
-
-inv_filtered = inventory[
-    (inventory['ELEMENT'] == variable) &
-    (inventory['FIRSTYEAR'] <= start_date.year) &
-    (inventory['LASTYEAR'] >= end_date.year)
+inventory = pd.read_csv(inventory_file, sep=r'\s+', engine='c', header=None,
+                        names=["ID", "LAT", "LON", "ELEMENT", "FIRSTYEAR", "LASTYEAR"],
+                        usecols=["ID", "ELEMENT", "FIRSTYEAR", "LASTYEAR"],
+                        dtype={'ID': 'category', 'ELEMENT': 'category',
+                               'FIRSTYEAR': 'int16', 'LASTYEAR': 'int16'})
+
+# Filter on ELEMENT first; it keeps only a small slice of the rows for the year checks
+inv_element = inventory[inventory['ELEMENT'] == variable]
+inv_filtered = inv_element[
+    (inv_element['FIRSTYEAR'] <= start_date.year) &
+    (inv_element['LASTYEAR'] >= end_date.year)
 ]
 print(f"Inventory filtered: {len(inv_filtered)} stations with {variable} between {start_date} and {end_date}.")
 
 #LOAD & FILTER STATIONS 
-station_data = []
-with open(station_file, 'r') as f:
-    for line in f:
-        station_id = line[0:11].strip()
-        lat = float(line[12:20].strip())
-        lon = float(line[21:30].strip())
-        name = line[41:71].strip()
-        if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
-            station_data.append((station_id, lat, lon, name))
-
-station_df = pd.DataFrame(station_data, columns=["ID", "LAT", "LON", "NAME"])
-station_df['ID'] = station_df['ID'].astype(str).str.strip()
+# Fixed-width records: slice the columns out of one (rows, 85) byte array
+with open(station_file, 'rb') as f:
+    station_rows = np.array(f.read().splitlines(), dtype='S85').view(np.uint8).reshape(-1, 85)
+lat = np.ascontiguousarray(station_rows[:, 12:20]).view('S8').ravel().astype(np.float64)
+lon = np.ascontiguousarray(station_rows[:, 21:30]).view('S9').ravel().astype(np.float64)
+in_box = (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+station_rows = station_rows[in_box]
+
+station_df = pd.DataFrame({
+    'ID': np.char.strip(np.ascontiguousarray(station_rows[:, 0:11]).view('S11').ravel()).astype(str),
+    'LAT': lat[in_box],
+    'LON': lon[in_box],
+    'NAME': np.char.strip(np.ascontiguousarray(station_rows[:, 41:71]).view('S30').ravel()).astype(str)
+})
+station_df['ID'] = station_df['ID'].astype('category')
 print(f"Found {len(station_df)} stations in bounding box.")
 
 # MERGE FILTERED STATIONS 
-stations = pd.merge(station_df, inv_filtered[['ID']], on='ID', how='inner')
+valid_ids = set(inv_filtered['ID'].to_numpy())
+stations = station_df[station_df['ID'].isin(valid_ids)].reset_index(drop=True)
 print(f"Final filtered station count: {len(stations)}")
 
+station_ids = stations['ID'].unique()
+station_paths = {station_id: os.path.join(dly_folder, f"{station_id}.dly") for station_id in station_ids}
+
 # DOWNLOAD .DLY FILES
 base_url = "https://www.ncei.noaa.gov/pub/data/ghcn/daily/all"
-for station_id in stations['ID'].unique():
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+def download_dly(station_id):
     url = f"{base_url}/{station_id}.dly"
-    dest = os.path.join(dly_folder, f"{station_id}.dly")
-    if not os.path.exists(dest):
-        try:
-            r = requests.get(url)
+    dest = station_paths[station_id]
+    headers = {}
+    if f"{station_id}.dly" in downloaded:
+        headers['If-Modified-Since'] = formatdate(os.path.getmtime(dest), usegmt=True)
+    try:
+        with session.get(url, headers=headers, stream=True, timeout=30) as r:
+            if r.status_code == 304:
+                return  # local copy is current
             if r.status_code == 200:
-                with open(dest, 'wb') as f:
-                    f.write(r.content)
+                # Stream to a temp file so an interrupted download never looks complete
+                r.raw.decode_content = True
+                with open(dest + '.part', 'wb') as f:
+                    shutil.copyfileobj(r.raw, f)
+                os.replace(dest + '.part', dest)
                 print(f"Downloaded {station_id}.dly")
             else:
                 print(f"Failed to download {station_id}: HTTP {r.status_code}")
-        except Exception as e:
-            print(f"Failed to download {station_id}: {e}")
+    except Exception as e:
+        print(f"Failed to download {station_id}: {e}")
+
+downloaded = {entry.name for entry in os.scandir(dly_folder)}
+# Local copies written on or before end_date may lack data for the window, so they are
+# revalidated with a conditional GET; newer copies are used as they are
+stale_before = datetime.combine(end_date + timedelta(days=1), datetime.min.time()).timestamp()
+to_download = [station_id for station_id in station_ids
+               if f"{station_id}.dly" not in downloaded
+               or os.path.getmtime(station_paths[station_id]) < stale_before]
+with ThreadPoolExecutor(max_workers=16) as executor:
+    list(executor.map(download_dly, to_download))
+downloaded = {entry.name for entry in os.scandir(dly_folder)}
 
 # PARSE DLY FILE FOR DATE RANGE
+@njit(cache=True)
+def date_to_ordinal(year, month, day):
+    # Same numbering as datetime.date.toordinal()
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 305
+
+@njit(cache=True)
+def ascii_digit(c):
+    # Digit value of an ASCII byte, 0 for the blanks and '-' that pad value fields
+    return (c - 48) * (c >= 48)
+
+@njit(cache=True, nogil=True)
+def decode_dly(buf):
+    # Decodes every valid value in a .dly buffer into (ordinal, value, element) arrays;
+    # the element is its 4 ASCII bytes packed big-endian into a uint32
+    n = len(buf)
+    nlines = 1
+    for i in range(n):
+        if buf[i] == 10:
+            nlines += 1
+    dates_out = np.empty(nlines * 31, dtype=np.int32)
+    values_out = np.empty(nlines * 31, dtype=np.int32)
+    elements_out = np.empty(nlines * 31, dtype=np.uint32)
+    count = 0
+    pos = 0
+    while pos < n:
+        end = pos
+        while end < n and buf[end] != 10:
+            end += 1
+        if end - pos >= 269:
+            element = 0
+            for k in range(17, 21):
+                element = element * 256 + buf[pos + k]
+            year = 0
+            for k in range(11, 15):
+                year = year * 10 + (buf[pos + k] - 48)
+            month = (buf[pos + 15] - 48) * 10 + (buf[pos + 16] - 48)
+            if 1 <= month <= 12:
+                first = date_to_ordinal(year, month, 1)
+                if month == 12:
+                    ndays = date_to_ordinal(year + 1, 1, 1) - first
+                else:
+                    ndays = date_to_ordinal(year, month + 1, 1) - first
+                for i in range(ndays):
+                    off = pos + 21 + i * 8
+                    # Missing days hold the literal '-9999'; skip them without decoding
+                    if (buf[off] == 45 and buf[off + 1] == 57 and buf[off + 2] == 57 and
+                            buf[off + 3] == 57 and buf[off + 4] == 57):
+                        continue
+                    c0, c1, c2, c3, c4 = buf[off], buf[off + 1], buf[off + 2], buf[off + 3], buf[off + 4]
+                    val = (ascii_digit(c0) * 10000 + ascii_digit(c1) * 1000 + ascii_digit(c2) * 100 +
+                           ascii_digit(c3) * 10 + ascii_digit(c4))
+                    negative = (c0 == 45) | (c1 == 45) | (c2 == 45) | (c3 == 45)
+                    dates_out[count] = first + i
+                    values_out[count] = val - 2 * val * negative
+                    elements_out[count] = element
+                    count += 1
+        pos = end + 1
+    return dates_out[:count], values_out[:count], elements_out[:count]
+
+def build_dly_cache(filepath, cache_path):
+    # Saves dates/values/elements sorted by element then date, plus each element's
+    # name and first/last date, to the .npz cache
+    with open(filepath, 'rb') as f:
+        # Decode straight from a read-only mapping of the file; empty files cannot be mapped
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                buf = np.frombuffer(mm, dtype=np.uint8)
+                dates, values, keys = decode_dly(buf)
+                del buf  # release the view so the mapping can close
+        else:
+            dates, values, keys = decode_dly(np.frombuffer(b'', dtype=np.uint8))
+    names, codes = np.unique(keys, return_inverse=True)
+    order = np.lexsort((dates, codes))
+    dates = dates[order]
+    values = values[order]
+    elements = codes[order].astype(np.uint8 if len(names) <= 256 else np.uint16)
+    element_names = names.astype('>u4').view('S4')
+    first_dates = dates[np.searchsorted(elements, np.arange(len(names)))]
+    last_dates = dates[np.searchsorted(elements, np.arange(len(names)), side='right') - 1]
+
+    with open(cache_path + '.part', 'wb') as f:
+        np.savez(f, dates=dates, values=values, elements=elements, element_names=element_names,
+                 first_dates=first_dates, last_dates=last_dates)
+    os.replace(cache_path + '.part', cache_path)
+
+def open_dly_cache(filepath):
+    # Opens the .npz cache next to the .dly, rebuilding it first when it is older
+    # than the .dly, unreadable, or missing the per-element coverage
+    cache_path = filepath[:-4] + '.npz'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(filepath):
+        try:
+            cache = np.load(cache_path)
+            if 'first_dates' in cache.files:
+                return cache
+            cache.close()
+        except Exception as e:
+            print(f"Ignoring unreadable cache {cache_path}: {e}")
+    build_dly_cache(filepath, cache_path)
+    return np.load(cache_path)
+
 def parse_dly(filepath, variable, start_date, end_date):
-    days_dict = {}  # maps date objects to counts
+    # Returns a mask of the days from start_date to end_date with a valid value
+    present = np.zeros((end_date - start_date).days + 1, dtype=np.bool_)
+    start_ord, end_ord = start_date.toordinal(), end_date.toordinal()
     try:
-        with open(filepath, 'r') as f:
-            for line in f:
-                if line[17:21] == variable:
-                    year = int(line[11:15])
-                    month = int(line[15:17])
-                    for i in range(31):
-                        try:
-                            val = int(line[21 + i*8 : 26 + i*8][:5])
-                            day = i + 1
-                            d = date(year, month, day)
-                            if start_date <= d <= end_date and val != -9999:
-                                if d not in days_dict:
-                                    days_dict[d] = 1
-                                else:
-                                    days_dict[d] += 1
-                        except:
-                            continue
+        with open_dly_cache(filepath) as cache:
+            match = np.flatnonzero(cache['element_names'] == variable.encode())
+            # Arrays are read lazily, so a station whose record of the variable lies
+            # entirely outside the window never loads its dates
+            if (len(match) and cache['first_dates'][match[0]] <= end_ord and
+                    cache['last_dates'][match[0]] >= start_ord):
+                lo, hi = np.searchsorted(cache['elements'], [match[0], match[0] + 1])
+                dates = cache['dates'][lo:hi]
+                first, last = np.searchsorted(dates, [start_ord, end_ord + 1])
+                present[dates[first:last] - start_ord] = True
     except Exception as e:
         print(f"Error parsing {filepath}: {e}")
-    return days_dict
+    return present
 
 # Generate date list for summary
 date_list = []
@@ -119,38 +264,47 @@ total = np.zeros(len(date_list))
 valid = np.zeros(len(date_list))
 missing_station_ids = [[] for _ in range(len(date_list))]
 
+# PARSE EACH STATION ONCE
+# decode_dly releases the GIL, so stations are parsed in parallel on threads
+def parse_station(station_id):
+    return parse_dly(station_paths[station_id], variable, start_date, end_date)
+
+parsed_ids = [station_id for station_id in station_ids if f"{station_id}.dly" in downloaded]
+with ThreadPoolExecutor() as executor:
+    results = dict(zip(parsed_ids, executor.map(parse_station, parsed_ids)))
+
 # LOOP THROUGH STATIONS
-for station_id in stations['ID'].unique():
-    path = os.path.join(dly_folder, f"{station_id}.dly")
-    if os.path.exists(path):
-        vals = parse_dly(path, variable, start_date, end_date)
-        missing_days = sum(1 for d in date_list if d not in vals)
-
-        # Skip this station in the summary if it's 100% missing
-        if missing_days == len(date_list):
-            continue
-
-        for i, d in enumerate(date_list):
-            total[i] += 1
-            if d in vals:
-                valid[i] += 1
-            else:
-                missing_station_ids[i].append(station_id)
+for station_id, present in results.items():
+    # Skip this station in the summary if it's 100% missing
+    if not present.any():
+        continue
+
+    valid += present
+    total += 1
+    for i in np.flatnonzero(~present):
+        missing_station_ids[i].append(station_id)
 
 # SUMMARY TABLE
 summary = pd.DataFrame({
     'Date': [d.strftime("%Y-%m-%d") for d in date_list],
-    'Stations Reporting': valid.astype(int),
-    'Stations Missing': (total - valid).astype(int),
-    'Total Stations': total.astype(int),
-    '% Missing': np.round((1 - valid / total) * 100, 1),
-    'Missing Station IDs': [', '.join(ids) if ids else '' for ids in missing_station_ids]
+    'Stations Reporting': valid.astype(np.int32),
+    'Stations Missing': (total - valid).astype(np.int32),
+    'Total Stations': total.astype(np.int32),
+    '% Missing': np.round((1 - valid / total) * 100, 1)
 })
 
+# One row per (day, station) that is missing data
+missing_long = pd.DataFrame(
+    [(d.strftime("%Y-%m-%d"), station_id)
+     for d, ids in zip(date_list, missing_station_ids) for station_id in ids],
+    columns=['Date', 'ID']
+)
+missing_long['ID'] = missing_long['ID'].astype('category')
+
 print(summary)
 
 # PLOT
-plt.figure(figsize=(12, 5))
+fig = plt.figure(figsize=(12, 5))
 plt.plot(summary['Date'], summary['% Missing'], marker='o', color='darkred')
 plt.title(f'% Missing {variable} from {start_date_str} to {end_date_str}')
 plt.xlabel('Date')
@@ -162,52 +316,61 @@ plt.yticks(np.arange(0, 101, 10))
 plt.xticks(rotation=45)
 plt.grid(True)
 plt.tight_layout()
-plt.show()
+plt.savefig(f'missing_{variable}_{start_date_str}_to_{end_date_str}.png', dpi=100)
+if interactive:
+    plt.show()
+plt.close(fig)
 print(f"Final filtered station count: {len(stations)}")
 print("\nSelected Stations:")
 print(stations[['ID', 'LAT', 'LON', 'NAME']].to_string(index=False))
 
 # --- Save stations with missing data ---
-stations_with_missing_data = []
-valid_stations = []
-
-for station_id in stations['ID'].unique():
-    path = os.path.join(dly_folder, f"{station_id}.dly")
-    if os.path.exists(path):
-        vals = parse_dly(path, variable, start_date, end_date)
-        total_days = len(date_list)
-        missing_days = sum(1 for d in date_list if d not in vals)
-
-        if missing_days < total_days:  # Exclude stations with 100% missing data
-            station_info = stations[stations['ID'] == station_id].iloc[0]
-            
-            if missing_days > 0:
-                stations_with_missing_data.append({
-                    'ID': station_id,
-                    'LAT': station_info['LAT'],
-                    'LON': station_info['LON'],
-                    'NAME': station_info['NAME'],
-                    'Total Days': total_days,
-                    'Missing Days': missing_days,
-                    'Missing %': round((missing_days / total_days) * 100, 2)
-                })
-
-            valid_stations.append(station_info)
-            
+total_days = len(date_list)
+missing_ids = np.empty(len(results), dtype='U11')
+missing_counts = np.empty(len(results), dtype=np.int32)
+n_missing = 0
+reporting_ids = []
+
+for station_id, present in results.items():
+    missing_days = total_days - np.count_nonzero(present)
+
+    if missing_days < total_days:  # Exclude stations with 100% missing data
+        if missing_days > 0:
+            missing_ids[n_missing] = station_id
+            missing_counts[n_missing] = missing_days
+            n_missing += 1
+
+        reporting_ids.append(station_id)
+
 # Save only valid stations (exclude 100% missing)
-valid_stations_df = pd.DataFrame(valid_stations).drop_duplicates()
+valid_stations_df = stations[stations['ID'].isin(reporting_ids)]
 
-missing_df = pd.DataFrame(stations_with_missing_data)
+station_info = stations.set_index('ID').loc[missing_ids[:n_missing]]
+missing_df = pd.DataFrame({
+    'ID': missing_ids[:n_missing],
+    'LAT': station_info['LAT'].to_numpy(),
+    'LON': station_info['LON'].to_numpy(),
+    'NAME': station_info['NAME'].to_numpy(),
+    'Total Days': total_days,
+    'Missing Days': missing_counts[:n_missing],
+    'Missing %': np.round(missing_counts[:n_missing] / total_days * 100, 2)
+})
 missing_df.to_csv(
     f'stations_with_missing_data_{variable}_{start_date_str}_to_{end_date_str}.csv',
-    index=False
+    index=False, lineterminator='\n'
 )
 
 print("Saved stations with missing data and frequency to CSV.")
 
 # SAVE OUTPUT
-summary.to_csv(f'missing_summary_{variable}_{start_date_str}_to_{end_date_str}.csv', index=False)
+summary.to_csv(f'missing_summary_{variable}_{start_date_str}_to_{end_date_str}.csv', index=False,
+               float_format='%.1f', lineterminator='\n')
 print("Summary saved to CSV.")
 
-stations[['ID', 'LAT', 'LON', 'NAME']].to_csv(f'selected_stations_{variable}_{start_date_str}_to_{end_date_str}.csv', index=False)
+missing_long.to_csv(f'missing_station_days_{variable}_{start_date_str}_to_{end_date_str}.csv', index=False,
+                    lineterminator='\n')
+print("Missing station IDs per day saved to CSV.")
+
+stations[['ID', 'LAT', 'LON', 'NAME']].to_csv(f'selected_stations_{variable}_{start_date_str}_to_{end_date_str}.csv', index=False,
+                                              lineterminator='\n')
 print("Selected stations saved to CSV.")
\ No newline at end of file